@@ -0,0 +1,71 @@
+"""
+Measures MappingsConverter throughput with a shared instance across thread counts.
+Requires the package to be installed, e.g. pip install -e .
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jsonschematomappings import MappingsConverter
+
+DEFAULT_SCHEMA = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "resources", "test_json_schema.json"
+)
+
+
+def run(converter, json_schema, threads, calls):
+    """
+    Converts json_schema calls times using a pool of threads
+
+    :return: conversions per second
+    :rtype: float
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(
+            lambda _: converter.to_mappings(json_schema), range(calls)
+        ):
+            pass
+    return calls / (time.perf_counter() - start)
+
+
+def process_arguments():
+    """
+    Define command line inputs
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA, help="JSON schema document")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16],
+        help="Thread counts to measure",
+    )
+    parser.add_argument(
+        "--calls", type=int, default=2000, help="Conversions per thread count"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = process_arguments()
+
+    converter = MappingsConverter()
+    with open(args.schema, "rt") as f:
+        json_schema = json.load(f)
+    # warm the caches so every thread count measures the same work
+    converter.to_mappings(json_schema)
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+    print(f"{'threads':>8} {'calls/s':>12}")
+    for threads in args.threads:
+        print(f"{threads:>8} {run(converter, json_schema, threads, args.calls):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
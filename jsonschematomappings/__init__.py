@@ -1,8 +1,26 @@
 import argparse
+import copy
+import hashlib
 import json
+import logging
+import marshal
+import threading
+from collections import OrderedDict, deque
 from collections.abc import Mapping
 from functools import cached_property
-from typing import Any, Dict, Optional, Union
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import fastjsonschema
 
@@ -17,12 +35,28 @@ JS_ID_KEY = "$id"
 JS_REF_KEY = "$ref"
 JS_DEF_REPLACE = "#/$defs/"
 JS_ADDITIONAL_PROPERTIES_KEY = "additionalProperties"
+# keys read when converting an object, which may sit alongside a reference
+JS_CONVERTED_KEYS = (JS_TYPE_KEY, JS_PROPERTIES_KEY, JS_ITEMS_KEY)
 
 # OpenSearch/Elasticsearch constants
 OS_MAPPINGS_KEY = "mappings"
 OS_PROPERTIES_KEY = "properties"
 OS_TYPE_KEY = "type"
 OS_NESTED_KEY = "nested"
+OS_ENABLED_KEY = "enabled"
+OS_FLATTENED_TYPE = "flattened"
+
+# Mappings used for recursive definitions beyond the maximum recursion depth
+RECURSION_DISABLED = "disabled"
+RECURSION_FLATTENED = "flattened"
+RECURSION_FALLBACKS: Dict[str, Dict[str, Any]] = {
+    RECURSION_DISABLED: {OS_TYPE_KEY: JS_OBJECT_TYPE, OS_ENABLED_KEY: False},
+    RECURSION_FLATTENED: {OS_TYPE_KEY: OS_FLATTENED_TYPE},
+}
+DEFAULT_MAX_RECURSION_DEPTH = 3
+
+# Maximum entries in each of MappingsConverter's caches
+DEFAULT_CACHE_SIZE = 1024
 
 TYPE_MAP = {
     "boolean": "boolean",
@@ -34,6 +68,15 @@ TYPE_MAP = {
 }
 
 
+logger = logging.getLogger(__name__)
+
+# definitions that reference each other in a cycle, and one such cycle
+_RecursiveGroup = Tuple[Tuple[str, ...], Tuple[str, ...]]
+# schema, conversion method, expansions of each recursive group the result
+# depends on, definition key and keys alongside the reference
+_RefCacheKey = Tuple[str, str, Tuple[Tuple[str, int], ...], str, str]
+
+
 class SchemaParsingException(Exception):
     pass
 
@@ -45,7 +88,11 @@ class JSONSchemaToMappings:
     """
 
     def __init__(
-        self, json_schema: Union[str, Dict], template: Optional[Union[str, Dict]] = None
+        self,
+        json_schema: Union[str, Dict],
+        template: Optional[Union[str, Dict]] = None,
+        max_recursion_depth: int = DEFAULT_MAX_RECURSION_DEPTH,
+        recursion_fallback: str = RECURSION_DISABLED,
     ):
         """
         Init method for conversion class
@@ -54,7 +101,18 @@ class JSONSchemaToMappings:
         :type json_schema: str or Dict
         :param template: template JSON mappings file or dict to add to
         :type template: str or Dict
+        :param max_recursion_depth: number of nested expansions of each group
+            of recursive definitions to convert
+        :type max_recursion_depth: int
+        :param recursion_fallback: mapping used beyond max_recursion_depth,
+            one of RECURSION_FALLBACKS
+        :type recursion_fallback: str
         """
+        # converts properties of this schema, validating the options
+        self._converter = MappingsConverter(
+            max_recursion_depth=max_recursion_depth,
+            recursion_fallback=recursion_fallback,
+        )
         self.json_schema = self._load_and_validate(json_schema)
 
         self.template = {}
@@ -114,7 +172,8 @@ class JSONSchemaToMappings:
         :param json_schema: JSON schema as a dict
         :type json_schema: Dict
         """
-        fastjsonschema.compile(json_schema)
+        # compile a copy, fastjsonschema rewrites references in place
+        fastjsonschema.compile(copy.deepcopy(json_schema))
         if JS_PROPERTIES_KEY not in json_schema:
             raise KeyError(f"Invalid schema, missing key '{JS_PROPERTIES_KEY}'")
 
@@ -138,6 +197,20 @@ class JSONSchemaToMappings:
         """
         return self.json_schema.get(JS_ID_KEY, "") + JS_DEF_REPLACE
 
+    @cached_property
+    def _context(self) -> "_ConversionContext":
+        """
+        Gets the conversion state for this schema
+
+        :return: conversion context
+        :rtype: _ConversionContext
+        """
+        return self._converter._context(
+            self._defs,
+            self._def_replace_key,
+            MappingsConverter._schema_key(self.json_schema),
+        )
+
     def _expand_def(self, o) -> Dict[str, Any]:
         """
         Expands an object from a definition reference
@@ -147,20 +220,669 @@ class JSONSchemaToMappings:
         :return: dict of OS mappings properties
         :rtype: Dict
         """
-        ref_key = o[JS_REF_KEY].replace(self._def_replace_key, "")
-        try:
-            expanded = {**o, **self._defs[ref_key]}
-        except KeyError:
-            raise SchemaParsingException(
-                f"Unable to find definition for reference '{ref_key}'"
-            )
-        del expanded[JS_REF_KEY]
-        return expanded
+        return self._converter._expand_def(o, self._context)
 
     def _update_dict(self, d, u):
         """
         Recursively updates dict with values from another
 
+        :param d: first dict
+        :type d: Dict
+        :param u: update dict, values overwrite first dict
+        :type: u: dict
+        """
+        return MappingsConverter._update_dict(d, u)
+
+    def _convert_property(self, o) -> Dict[str, Any]:
+        """
+        Converts JSON schema properties to OpenSearch/ElasticSearch mappings
+
+        :param o: dict/object to convert
+        :type o: Dict
+        :return: dict of OS mappings properties
+        :rtype: Dict
+        """
+        return MappingsConverter._copy_mappings(
+            self._converter._convert_properties(o, self._context)
+        )
+
+    def _convert_array(self, arr) -> Dict[str, Any]:
+        """
+        Factored out method for converting array types
+        """
+        return MappingsConverter._copy_mappings(
+            self._converter._convert_array(arr, self._context)
+        )
+
+
+class _Recursion(NamedTuple):
+    """
+    Definitions of a JSON schema that reference each other in a cycle
+    """
+
+    # definitions in each group, in order found, and one cycle through them
+    groups: Tuple[_RecursiveGroup, ...]
+    # group of each recursive definition, named by the group's first definition
+    group_of: Dict[str, str]
+    # groups reachable from each definition, including its own
+    reachable: Dict[str, FrozenSet[str]]
+
+
+class _ConversionContext:
+    """
+    Per-call state for converting a single JSON schema
+    """
+
+    __slots__ = (
+        "defs",
+        "def_replace_key",
+        "schema_key",
+        "recursion",
+        "counts",
+        "converted",
+    )
+
+    def __init__(self, defs: Dict, def_replace_key: str, schema_key: str):
+        """
+        Init method for conversion context
+
+        :param defs: reference definitions from the JSON schema
+        :type defs: Dict
+        :param def_replace_key: prefix string to replace in a definition reference
+        :type def_replace_key: str
+        :param schema_key: identifies the JSON schema in the converter's caches
+        :type schema_key: str
+        """
+        self.defs = defs
+        self.def_replace_key = def_replace_key
+        self.schema_key = schema_key
+        self.recursion = _Recursion((), {}, {})
+        # expansions of each recursive group in the chain being converted
+        self.counts: Dict[str, int] = {}
+        # converted references for this schema, kept for the whole conversion
+        # so work stays linear however small the converter's caches are
+        self.converted: Dict[_RefCacheKey, Dict[str, Any]] = {}
+
+    def ref_key(self, ref: str) -> str:
+        """
+        Gets the definition key from a definition reference
+
+        :param ref: definition reference
+        :type ref: str
+        :return: definition key
+        :rtype: str
+        """
+        # references may or may not be qualified with the schema $id
+        for prefix in (self.def_replace_key, JS_DEF_REPLACE):
+            if ref.startswith(prefix):
+                return ref.replace(prefix, "", 1)
+        return ref
+
+    def enter(self, group: Optional[str]):
+        """
+        Counts an expansion of a recursive group in the chain being converted
+
+        :param group: recursive group, or None if the definition is not recursive
+        :type group: str
+        """
+        if group is not None:
+            self.counts[group] = self.counts.get(group, 0) + 1
+
+    def exit(self, group: Optional[str]):
+        """
+        Removes an expansion counted by enter
+
+        :param group: recursive group, or None if the definition is not recursive
+        :type group: str
+        """
+        if group is not None:
+            if self.counts[group] > 1:
+                self.counts[group] -= 1
+            else:
+                del self.counts[group]
+
+    def find_recursion(self) -> _Recursion:
+        """
+        Finds groups of definitions that reference each other in a cycle,
+        i.e. the strongly connected components of the definition references
+        (Tarjan's algorithm). A definition referencing itself is a group of one.
+
+        :return: recursive groups and the groups reachable from each definition
+        :rtype: _Recursion
+        """
+        graph = {
+            k: [ref for ref in self._def_refs(v) if ref in self.defs]
+            for k, v in self.defs.items()
+        }
+        index: Dict[str, int] = {}
+        low: Dict[str, int] = {}
+        # definitions not yet assigned to a component, and their positions
+        stack: List[str] = []
+        on_stack: Dict[str, int] = {}
+        components: List[List[str]] = []
+
+        for root in graph:
+            if root not in index:
+                self._strong_connect(
+                    root, graph, index, low, stack, on_stack, components
+                )
+
+        groups, reachable = self._reachable_groups(graph, components)
+        groups.sort(key=lambda g: index[g[0]])
+        return _Recursion(
+            tuple((tuple(g), self._group_cycle(graph, g)) for g in groups),
+            {k: g[0] for g in groups for k in g},
+            reachable,
+        )
+
+    @staticmethod
+    def _strong_connect(
+        root: str,
+        graph: Dict[str, List[str]],
+        index: Dict[str, int],
+        low: Dict[str, int],
+        stack: List[str],
+        on_stack: Dict[str, int],
+        components: List[List[str]],
+    ):
+        """
+        Visits the definitions reachable from root for Tarjan's algorithm,
+        adding each strongly connected component to components after every
+        component it references
+
+        :param root: definition key to start from
+        :type root: str
+        :param graph: definition keys referenced by each definition
+        :type graph: Dict
+        """
+        index[root] = low[root] = len(index)
+        on_stack[root] = len(stack)
+        stack.append(root)
+
+        # chain of definitions currently being expanded
+        chain = [(root, iter(graph[root]))]
+        while chain:
+            k, refs = chain[-1]
+            for ref in refs:
+                if ref not in index:
+                    index[ref] = low[ref] = len(index)
+                    on_stack[ref] = len(stack)
+                    stack.append(ref)
+                    chain.append((ref, iter(graph[ref])))
+                    break
+                if ref in on_stack:
+                    low[k] = min(low[k], index[ref])
+            else:
+                chain.pop()
+                if chain:
+                    parent = chain[-1][0]
+                    low[parent] = min(low[parent], low[k])
+                if low[k] == index[k]:
+                    start = on_stack[k]
+                    component = stack[start:]
+                    del stack[start:]
+                    for member in component:
+                        del on_stack[member]
+                    components.append(component)
+
+    @staticmethod
+    def _reachable_groups(
+        graph: Dict[str, List[str]], components: List[List[str]]
+    ) -> Tuple[List[List[str]], Dict[str, FrozenSet[str]]]:
+        """
+        Finds the recursive groups, components with a cycle, and the groups
+        reachable from each definition
+
+        :param graph: definition keys referenced by each definition
+        :type graph: Dict
+        :param components: strongly connected components, each after every
+            component it references
+        :type components: List
+        :return: recursive groups and the groups reachable from each definition
+        :rtype: Tuple
+        """
+        groups: List[List[str]] = []
+        reachable: Dict[str, FrozenSet[str]] = {}
+        for component in components:
+            members = set(component)
+            found: Set[str] = set()
+            for k in component:
+                for ref in graph[k]:
+                    if ref not in members:
+                        found.update(reachable[ref])
+            if len(component) > 1 or component[0] in graph[component[0]]:
+                groups.append(component)
+                found.add(component[0])
+            component_reachable = frozenset(found)
+            for k in component:
+                reachable[k] = component_reachable
+        return groups, reachable
+
+    @staticmethod
+    def _group_cycle(graph: Dict[str, List[str]], group: List[str]) -> Tuple[str, ...]:
+        """
+        Finds the shortest cycle through the first definition of a group
+        with a breadth first search of the group's references
+
+        :param graph: definition keys referenced by each definition
+        :type graph: Dict
+        :param group: definitions that reference each other in a cycle
+        :type group: List
+        :return: chain of definition keys, ending where the cycle repeats
+        :rtype: Tuple
+        """
+        root = group[0]
+        members = set(group)
+        parents: Dict[str, str] = {}
+        queue = deque([root])
+        while queue:
+            k = queue.popleft()
+            for ref in graph[k]:
+                if ref == root:
+                    chain = [k]
+                    while chain[-1] != root:
+                        chain.append(parents[chain[-1]])
+                    return tuple(reversed(chain)) + (root,)
+                if ref in members and ref not in parents:
+                    parents[ref] = k
+                    queue.append(ref)
+        raise ValueError(f"No cycle through '{root}'")
+
+    def _def_refs(self, o) -> List[str]:
+        """
+        Gets the definition keys referenced within an object, following only
+        the properties and items that conversion follows
+
+        :param o: dict/object to search
+        :return: definition keys, without duplicates
+        :rtype: List
+        """
+        refs: Dict[str, None] = {}
+        stack = [o]
+        while stack:
+            v = stack.pop()
+            if not isinstance(v, Mapping):
+                continue
+            if isinstance(v.get(JS_REF_KEY), str):
+                refs[self.ref_key(v[JS_REF_KEY])] = None
+            if isinstance(v.get(JS_ITEMS_KEY), Mapping):
+                stack.append(v[JS_ITEMS_KEY])
+            if isinstance(v.get(JS_PROPERTIES_KEY), Mapping):
+                stack.extend(reversed(list(v[JS_PROPERTIES_KEY].values())))
+        return list(refs)
+
+
+class MappingsConverter:
+    """
+    Reusable, thread-safe class for converting JSON schema documents to
+    OpenSearch/ElasticSearch mappings documents.
+
+    Holds configuration and caches only; the schema is passed per call and
+    is never modified, so a single instance can be shared between threads.
+    """
+
+    __slots__ = (
+        "_template",
+        "_type_map",
+        "_max_recursion_depth",
+        "_recursion_fallback",
+        "_validators",
+        "_converted_defs",
+        "_cycles",
+        "_cache_size",
+        "_lock",
+    )
+
+    _template: Dict[str, Any]
+    _type_map: Mapping
+    _max_recursion_depth: int
+    _recursion_fallback: str
+    _validators: "OrderedDict[str, Callable]"
+    _converted_defs: "OrderedDict[_RefCacheKey, Dict[str, Any]]"
+    _cycles: "OrderedDict[str, _Recursion]"
+    _cache_size: int
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        template: Optional[Union[str, Dict]] = None,
+        type_map: Optional[Dict[str, str]] = None,
+        max_recursion_depth: int = DEFAULT_MAX_RECURSION_DEPTH,
+        recursion_fallback: str = RECURSION_DISABLED,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        """
+        Init method for converter class
+
+        :param template: template JSON mappings file or dict to add to
+        :type template: str or Dict
+        :param type_map: JSON schema to OS type overrides, merged over TYPE_MAP
+        :type type_map: Dict
+        :param max_recursion_depth: number of nested expansions of each group
+            of recursive definitions to convert, beyond which
+            recursion_fallback is used
+        :type max_recursion_depth: int
+        :param recursion_fallback: mapping used beyond max_recursion_depth,
+            one of RECURSION_FALLBACKS
+        :type recursion_fallback: str
+        :param cache_size: maximum entries in each cache, least recently
+            used entries are evicted first
+        :type cache_size: int
+        """
+        if max_recursion_depth < 0:
+            raise ValueError(
+                f"max_recursion_depth must be 0 or more, got {max_recursion_depth}"
+            )
+        if recursion_fallback not in RECURSION_FALLBACKS:
+            raise ValueError(
+                f"Unknown recursion_fallback '{recursion_fallback}', "
+                f"expected one of {sorted(RECURSION_FALLBACKS)}"
+            )
+        if cache_size < 0:
+            raise ValueError(f"cache_size must be 0 or more, got {cache_size}")
+
+        if isinstance(template, str):
+            template = self._load_json_doc(template)
+
+        _set = object.__setattr__
+        _set(self, "_template", copy.deepcopy(template or {}))
+        _set(self, "_type_map", MappingProxyType({**TYPE_MAP, **(type_map or {})}))
+        _set(self, "_max_recursion_depth", max_recursion_depth)
+        _set(self, "_recursion_fallback", recursion_fallback)
+        _set(self, "_validators", OrderedDict())
+        _set(self, "_converted_defs", OrderedDict())
+        _set(self, "_cycles", OrderedDict())
+        _set(self, "_cache_size", cache_size)
+        _set(self, "_lock", threading.Lock())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} instances are immutable")
+
+    @property
+    def template(self) -> Dict[str, Any]:
+        """
+        Gets a copy of the template mappings
+
+        :return: template dict
+        :rtype: Dict
+        """
+        return copy.deepcopy(self._template)
+
+    @property
+    def type_map(self) -> Mapping:
+        """
+        Gets the read-only JSON schema to OS type map
+
+        :return: type map
+        :rtype: Mapping
+        """
+        return self._type_map
+
+    @property
+    def max_recursion_depth(self) -> int:
+        """
+        Gets the number of nested expansions of each recursive group converted
+
+        :return: maximum recursion depth
+        :rtype: int
+        """
+        return self._max_recursion_depth
+
+    @property
+    def recursion_fallback(self) -> str:
+        """
+        Gets the name of the mapping used beyond the maximum recursion depth
+
+        :return: key of RECURSION_FALLBACKS
+        :rtype: str
+        """
+        return self._recursion_fallback
+
+    @property
+    def cache_size(self) -> int:
+        """
+        Gets the maximum number of entries in each cache
+
+        :return: cache size
+        :rtype: int
+        """
+        return self._cache_size
+
+    def to_mappings(self, json_schema: Union[str, Dict]) -> Dict[str, Any]:
+        """
+        Convert JSON schema to an OpenSearch/ElasticSearch mappings document
+
+        :param json_schema: JSON file path or JSON schema as a dict
+        :type json_schema: str or Dict
+        :return: mappings dict
+        :rtype: Dict
+        """
+        json_schema, schema_key = self._load_and_validate(json_schema)
+        context = self._schema_context(json_schema, schema_key)
+        properties = self._convert_properties(json_schema[JS_PROPERTIES_KEY], context)
+        mappings = {
+            OS_MAPPINGS_KEY: {OS_PROPERTIES_KEY: self._copy_mappings(properties)}
+        }
+
+        # merge a copy of the template so it is never shared between calls
+        return self._update_dict(self.template, mappings)
+
+    def find_cycles(self, json_schema: Union[str, Dict]) -> List[List[str]]:
+        """
+        Finds cycles between definitions in a JSON schema, one for each group
+        of definitions that reference each other
+
+        :param json_schema: JSON file path or JSON schema as a dict
+        :type json_schema: str or Dict
+        :return: chains of definition keys, each ending where the cycle repeats
+        :rtype: List
+        """
+        json_schema, schema_key = self._load_and_validate(json_schema)
+        context = self._schema_context(json_schema, schema_key)
+        return [list(cycle) for _, cycle in context.recursion.groups]
+
+    def clear_cache(self):
+        """
+        Empties the compiled validator, converted definition and cycle caches
+        """
+        with self._lock:
+            self._validators.clear()
+            self._converted_defs.clear()
+            self._cycles.clear()
+
+    def _cache_get(self, cache: "OrderedDict[Any, Any]", key: Any) -> Any:
+        """
+        Gets a value from a least recently used cache
+
+        :param cache: cache dict
+        :type cache: OrderedDict
+        :param key: cache key
+        :return: cached value, or None if missing
+        """
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+        return value
+
+    def _cache_set(self, cache: "OrderedDict[Any, Any]", key: Any, value: Any) -> Any:
+        """
+        Stores a value in a least recently used cache, evicting the least
+        recently used entries beyond the cache size. If another caller
+        stored a value for key first, that value wins.
+
+        :param cache: cache dict
+        :type cache: OrderedDict
+        :param key: cache key
+        :param value: value to store
+        :return: cached value
+        """
+        with self._lock:
+            value = cache.setdefault(key, value)
+            cache.move_to_end(key)
+            while len(cache) > self._cache_size:
+                cache.popitem(last=False)
+        return value
+
+    def _cached(
+        self,
+        cache: "OrderedDict[Any, Any]",
+        key: Any,
+        factory: Callable[[], Any],
+        on_store: Optional[Callable[[Any], None]] = None,
+    ) -> Any:
+        """
+        Gets a value from a least recently used cache, creating and storing it
+        if missing. Concurrent misses may both call factory.
+
+        :param cache: cache dict
+        :type cache: OrderedDict
+        :param key: cache key
+        :param factory: called with no arguments to create a missing value
+        :type factory: Callable
+        :param on_store: called with the value only by the caller that stored it
+        :type on_store: Callable
+        :return: cached value
+        """
+        value = self._cache_get(cache, key)
+        if value is None:
+            created = factory()
+            value = self._cache_set(cache, key, created)
+            if on_store is not None and value is created:
+                on_store(value)
+        return value
+
+    def _schema_context(self, json_schema, schema_key: str) -> _ConversionContext:
+        """
+        Gets the conversion state for a loaded JSON schema
+
+        :param json_schema: JSON schema as a dict
+        :type json_schema: Dict
+        :param schema_key: identifies the JSON schema in the caches
+        :type schema_key: str
+        :return: conversion context
+        :rtype: _ConversionContext
+        """
+        return self._context(
+            json_schema.get(JS_DEFS_KEY, {}),
+            json_schema.get(JS_ID_KEY, "") + JS_DEF_REPLACE,
+            schema_key,
+        )
+
+    def _context(
+        self, defs: Dict, def_replace_key: str, schema_key: str
+    ) -> _ConversionContext:
+        """
+        Creates the conversion state for a schema's definitions,
+        finding and reporting any cycles between them
+
+        :param defs: reference definitions from the JSON schema
+        :type defs: Dict
+        :param def_replace_key: prefix string to replace in a definition reference
+        :type def_replace_key: str
+        :param schema_key: identifies the JSON schema in the caches
+        :type schema_key: str
+        :return: conversion context
+        :rtype: _ConversionContext
+        """
+        context = _ConversionContext(defs, def_replace_key, schema_key)
+        context.recursion = self._cached(
+            self._cycles,
+            schema_key,
+            context.find_recursion,
+            on_store=self._report_cycles,
+        )
+        return context
+
+    def _report_cycles(self, recursion: _Recursion):
+        """
+        Logs a warning for each group of definitions that reference each other
+
+        :param recursion: recursive groups found in a schema
+        :type recursion: _Recursion
+        """
+        for group, cycle in recursion.groups:
+            logger.warning(
+                "Recursive definitions %s (cycle %s), converting to depth %d",
+                ", ".join(group),
+                " -> ".join(cycle),
+                self._max_recursion_depth,
+            )
+
+    def _load_and_validate(self, json_schema) -> Tuple[Dict[str, Any], str]:
+        """
+        Loads/parses and validates given JSON schema (dict or JSON file)
+
+        :return: JSON as dict and the key identifying it in the caches
+        :rtype: Tuple
+        """
+        if isinstance(json_schema, str):
+            json_schema = self._load_json_doc(json_schema)
+
+        schema_key = self._schema_key(json_schema)
+        self._validator(json_schema, schema_key)
+        if JS_PROPERTIES_KEY not in json_schema:
+            raise KeyError(f"Invalid schema, missing key '{JS_PROPERTIES_KEY}'")
+
+        return json_schema, schema_key
+
+    @staticmethod
+    def _schema_key(json_schema) -> str:
+        """
+        Gets the key identifying a JSON schema in the caches.
+        The schema is serialized once per call and every cache key
+        for that call is derived from this.
+
+        :param json_schema: JSON schema as a dict
+        :type json_schema: Dict
+        :return: digest of the serialized schema
+        :rtype: str
+        """
+        # marshal is several times faster than json. Version 0 has no
+        # back-references, which depend on refcounts, so output depends only
+        # on content; equal schemas in a different key order just miss
+        try:
+            serialized = marshal.dumps(json_schema, 0)
+        except ValueError:
+            # e.g. dict subclasses, which marshal does not support
+            serialized = json.dumps(json_schema, sort_keys=True).encode()
+        return hashlib.sha256(serialized).hexdigest()
+
+    @staticmethod
+    def _load_json_doc(json_schema_file) -> Dict[str, Any]:
+        """
+        Loads a JSON document file into a dict
+
+        :return: JSON as dict
+        :rtype: Dict
+        """
+        with open(json_schema_file, "rt") as f:
+            return json.load(f)
+
+    def _validator(self, json_schema, schema_key: str) -> Callable:
+        """
+        Gets the compiled validator for a JSON schema dict.
+        Raises an exception if schema is not valid.
+
+        :param json_schema: JSON schema as a dict
+        :type json_schema: Dict
+        :param schema_key: identifies the JSON schema in the caches
+        :type schema_key: str
+        :return: compiled validator
+        :rtype: Callable
+        """
+        return self._cached(
+            self._validators,
+            schema_key,
+            # compile a copy, fastjsonschema rewrites references in place
+            lambda: fastjsonschema.compile(copy.deepcopy(json_schema)),
+        )
+
+    @staticmethod
+    def _update_dict(d, u):
+        """
+        Recursively updates dict with values from another
+
         :param d: first dict
         :type d: Dict
         :param u: update dict, values overwrite first dict
@@ -168,68 +890,208 @@ class JSONSchemaToMappings:
         """
         for k, v in u.items():
             if isinstance(v, Mapping):
-                d[k] = self._update_dict(d.get(k, {}), v)
+                d[k] = MappingsConverter._update_dict(d.get(k, {}), v)
             else:
                 d[k] = v
         return d
 
-    def _convert_property(self, o) -> Dict[str, Any]:
+    @staticmethod
+    def _copy_mappings(mappings: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Copies converted mappings, which may share cached dicts, into a tree
+        of new dicts. Iterative so deeply nested mappings can be copied.
+
+        :param mappings: converted mappings
+        :type mappings: Dict
+        :return: copy of mappings
+        :rtype: Dict
+        """
+        copied: Dict[str, Any] = {}
+        stack = [(mappings, copied)]
+        while stack:
+            src, dst = stack.pop()
+            for k, v in src.items():
+                if isinstance(v, dict):
+                    dst[k] = {}
+                    stack.append((v, dst[k]))
+                else:
+                    dst[k] = v
+        return copied
+
+    def _expand_def(self, o, context: _ConversionContext) -> Dict[str, Any]:
+        """
+        Expands an object from a definition reference
+
+        :param o: dict/object to convert
+        :type o: Dict
+        :param context: conversion state for the schema
+        :type context: _ConversionContext
+        :return: expanded dict/object
+        :rtype: Dict
+        """
+        ref_key = context.ref_key(o[JS_REF_KEY])
+        try:
+            expanded = {**o, **context.defs[ref_key]}
+        except KeyError:
+            raise SchemaParsingException(
+                f"Unable to find definition for reference '{ref_key}'"
+            )
+        del expanded[JS_REF_KEY]
+        return expanded
+
+    def _convert_ref(
+        self,
+        o,
+        context: _ConversionContext,
+        convert: Callable[[Dict, _ConversionContext], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """
+        Expands and converts a definition reference, caching the result.
+        Recursive definitions whose group is already expanded the maximum
+        recursion depth times in the current chain are converted to the
+        recursion fallback mapping instead. The caches are checked here
+        rather than through _cached so each nested reference adds as few
+        stack frames as possible.
+
+        :param o: dict/object containing the reference
+        :type o: Dict
+        :param context: conversion state for the schema
+        :type context: _ConversionContext
+        :param convert: method to convert the expanded object with
+        :type convert: Callable
+        :return: dict of OS mappings properties, shared with the caches
+        :rtype: Dict
+        """
+        ref_key = context.ref_key(o[JS_REF_KEY])
+        group = context.recursion.group_of.get(ref_key)
+        if group is not None:
+            if context.counts.get(group, 0) >= self._max_recursion_depth:
+                return RECURSION_FALLBACKS[self._recursion_fallback]
+
+        key = self._ref_cache_key(o, context, ref_key, convert.__name__)
+        converted = context.converted.get(key)
+        if converted is None:
+            converted = self._cache_get(self._converted_defs, key)
+        if converted is None:
+            expanded = self._expand_def(o, context)
+            context.enter(group)
+            try:
+                created = convert(expanded, context)
+            finally:
+                context.exit(group)
+            converted = self._cache_set(self._converted_defs, key, created)
+        context.converted[key] = converted
+        return converted
+
+    @staticmethod
+    def _ref_cache_key(
+        o, context: _ConversionContext, ref_key: str, convert_name: str
+    ) -> _RefCacheKey:
+        """
+        Gets the key identifying a converted definition reference in the caches
+
+        :param o: dict/object containing the reference
+        :type o: Dict
+        :param context: conversion state for the schema
+        :type context: _ConversionContext
+        :param ref_key: definition key
+        :type ref_key: str
+        :param convert_name: name of the method converting the expanded object
+        :type convert_name: str
+        :return: cache key
+        :rtype: Tuple
+        """
+        # keys alongside the reference are only serialized if conversion reads them
+        siblings = {k: o[k] for k in JS_CONVERTED_KEYS if k in o}
+        if siblings:
+            # these may reference any definition, so every expansion counts
+            counts = tuple(sorted(context.counts.items()))
+        else:
+            # results depend only on the expansions of groups the definition
+            # reaches, so each is converted once per combination of those
+            reachable = context.recursion.reachable.get(ref_key, frozenset())
+            counts = tuple(
+                sorted((g, n) for g, n in context.counts.items() if g in reachable)
+            )
+        return (
+            context.schema_key,
+            convert_name,
+            counts,
+            ref_key,
+            json.dumps(siblings, sort_keys=True) if siblings else "",
+        )
+
+    def _convert_properties(self, o, context: _ConversionContext) -> Dict[str, Any]:
         """
         Recursively called method to convert JSON schema properties
         to OpenSearch/ElasticSearch mappings
 
         :param o: dict/object to convert
         :type o: Dict
+        :param context: conversion state for the schema
+        :type context: _ConversionContext
         :return: dict of OS mappings properties
         :rtype: Dict
         """
         converted: Dict[str, Any] = {}
 
-        for k in o:
+        for k, v in o.items():
             # "additionalProperties" (bool) is used in JSON schema to denote
             # if additional properties beyond those listed are permitted.
             # BUT it can also be a valid property key, so we need to check the type
-            if k == JS_ADDITIONAL_PROPERTIES_KEY and isinstance(o[k], bool):
+            if k == JS_ADDITIONAL_PROPERTIES_KEY and isinstance(v, bool):
                 continue
 
             # expand definition if ref is present
-            if JS_REF_KEY in o[k]:
-                o[k] = self._expand_def(o[k])
-
-            # get type of this property
-            t = o[k].get(JS_TYPE_KEY)
-            if t is None:
-                raise SchemaParsingException(
-                    "Invalid schema, "
-                    f"object missing type key '{JS_TYPE_KEY}': {json.dumps(o[k])}"
-                )
+            if JS_REF_KEY in v:
+                converted[k] = self._convert_ref(v, context, self._convert_property)
+            else:
+                converted[k] = self._convert_property(v, context)
 
-            # object type (dict) - recurse
-            if t == JS_OBJECT_TYPE and JS_PROPERTIES_KEY in o[k]:
-                converted[k] = {
-                    OS_PROPERTIES_KEY: self._convert_property(o=o[k][JS_PROPERTIES_KEY])
-                }
+        return converted
 
-            # array/list type
-            elif t == JS_ARRAY_TYPE:
-                converted[k] = self._convert_array(o[k])
+    def _convert_property(self, p, context: _ConversionContext) -> Dict[str, Any]:
+        """
+        Converts a single JSON schema property
 
-            # element type e.g. string, integer
-            elif t in TYPE_MAP:
-                converted[k] = {OS_TYPE_KEY: TYPE_MAP[t]}
+        :param p: property dict/object to convert
+        :type p: Dict
+        :param context: conversion state for the schema
+        :type context: _ConversionContext
+        :return: dict of OS mappings for the property
+        :rtype: Dict
+        """
+        # get type of this property
+        t = p.get(JS_TYPE_KEY)
+        if t is None:
+            raise SchemaParsingException(
+                "Invalid schema, "
+                f"object missing type key '{JS_TYPE_KEY}': {json.dumps(p)}"
+            )
 
-            # not trying to parse any other types
-            else:
-                raise SchemaParsingException(f"Unknown property type '{t}'")
+        # object type (dict) - recurse
+        if t == JS_OBJECT_TYPE and JS_PROPERTIES_KEY in p:
+            return {
+                OS_PROPERTIES_KEY: self._convert_properties(
+                    p[JS_PROPERTIES_KEY], context
+                )
+            }
 
-        return converted
+        # array/list type
+        if t == JS_ARRAY_TYPE:
+            return self._convert_array(p, context)
 
-    def _convert_array(self, arr) -> Dict[str, Any]:
+        # element type e.g. string, integer
+        if t in self._type_map:
+            return {OS_TYPE_KEY: self._type_map[t]}
+
+        # not trying to parse any other types
+        raise SchemaParsingException(f"Unknown property type '{t}'")
+
+    def _convert_array(self, arr, context: _ConversionContext) -> Dict[str, Any]:
         """
         Factored out method for converting array types
         """
-        converted: Dict[str, Any] = {}
-
         if JS_ITEMS_KEY not in arr:
             raise SchemaParsingException(
                 f"Invalid schema, {JS_ARRAY_TYPE} type missing "
@@ -238,34 +1100,39 @@ class JSONSchemaToMappings:
 
         # expand object described under items key
         if JS_REF_KEY in arr[JS_ITEMS_KEY]:
-            arr[JS_ITEMS_KEY] = self._expand_def(arr[JS_ITEMS_KEY])
+            return self._convert_ref(arr[JS_ITEMS_KEY], context, self._convert_items)
 
+        return self._convert_items(arr[JS_ITEMS_KEY], context)
+
+    def _convert_items(self, items, context: _ConversionContext) -> Dict[str, Any]:
+        """
+        Converts the object described under an array's items key
+        """
         # get type of array items
-        at = arr[JS_ITEMS_KEY].get(JS_TYPE_KEY)
+        at = items.get(JS_TYPE_KEY)
         if at is None:
             raise SchemaParsingException(
                 f"Invalid schema, {JS_ARRAY_TYPE} items object missing "
                 f"{JS_TYPE_KEY} key '{JS_TYPE_KEY}': "
-                f"{json.dumps(arr[JS_ITEMS_KEY])}"
+                f"{json.dumps(items)}"
             )
 
         # if array items are themselves objects, mark as nested and recurse
         if at == JS_OBJECT_TYPE:
-            converted[OS_TYPE_KEY] = OS_NESTED_KEY
-            converted[OS_PROPERTIES_KEY] = self._convert_property(
-                arr[JS_ITEMS_KEY][JS_PROPERTIES_KEY]
-            )
+            return {
+                OS_TYPE_KEY: OS_NESTED_KEY,
+                OS_PROPERTIES_KEY: self._convert_properties(
+                    items[JS_PROPERTIES_KEY], context
+                ),
+            }
         # if array items are elements, OS/ES does not denote this
-        elif at in TYPE_MAP:
-            converted[OS_TYPE_KEY] = TYPE_MAP[at]
-        # TODO: deal with nested lists
-        else:
-            raise SchemaParsingException(
-                f"Unable to parse type '{at}' within {JS_ARRAY_TYPE}: "
-                f"{arr[JS_ITEMS_KEY]}"
-            )
+        if at in self._type_map:
+            return {OS_TYPE_KEY: self._type_map[at]}
 
-        return converted
+        # TODO: deal with nested lists
+        raise SchemaParsingException(
+            f"Unable to parse type '{at}' within {JS_ARRAY_TYPE}: {items}"
+        )
 
 
 def main():
@@ -274,7 +1141,12 @@ def main():
     """
     args = process_arguments()
 
-    mappings = jsonschematomappings(args.json_schema[0], args.template)
+    mappings = jsonschematomappings(
+        args.json_schema[0],
+        args.template,
+        args.max_recursion_depth,
+        args.recursion_fallback,
+    )
 
     print(json.dumps(mappings, indent=2))
 
@@ -292,11 +1164,26 @@ def process_arguments():
     # Define the arguments that will be taken.
     parser.add_argument("json_schema", nargs=1, help="JSON schema document")
     parser.add_argument("--template", type=str, help="Template mappings document")
+    parser.add_argument(
+        "--max-recursion-depth",
+        type=int,
+        default=DEFAULT_MAX_RECURSION_DEPTH,
+        help="Nested expansions of recursive definitions to convert",
+    )
+    parser.add_argument(
+        "--recursion-fallback",
+        choices=sorted(RECURSION_FALLBACKS),
+        default=RECURSION_DISABLED,
+        help="Mapping used for recursive definitions beyond the maximum depth",
+    )
     return parser.parse_args()
 
 
 def jsonschematomappings(
-    json_schema: Union[str, Dict], template: Optional[Union[str, Dict]] = None
+    json_schema: Union[str, Dict],
+    template: Optional[Union[str, Dict]] = None,
+    max_recursion_depth: int = DEFAULT_MAX_RECURSION_DEPTH,
+    recursion_fallback: str = RECURSION_DISABLED,
 ) -> Dict[str, Any]:
     """
     Wrapper method for functional users.
@@ -306,10 +1193,18 @@ def jsonschematomappings(
     :type json_schema: str or Dict
     :param template: template JSON mappings file to add to
     :type template: str or Dict
+    :param max_recursion_depth: number of nested expansions of each group
+        of recursive definitions to convert
+    :type max_recursion_depth: int
+    :param recursion_fallback: mapping used beyond max_recursion_depth,
+        one of RECURSION_FALLBACKS
+    :type recursion_fallback: str
     :return: mappings dict
     :rtype: Dict
     """
-    return JSONSchemaToMappings(json_schema, template).to_mappings()
+    return JSONSchemaToMappings(
+        json_schema, template, max_recursion_depth, recursion_fallback
+    ).to_mappings()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
+import copy
 import json
 import os
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import mock_open, patch
 
 import fastjsonschema
@@ -8,8 +12,13 @@ import pytest
 from deepdiff import DeepDiff
 
 from jsonschematomappings import (
+    DEFAULT_MAX_RECURSION_DEPTH,
+    RECURSION_DISABLED,
+    RECURSION_FLATTENED,
     JSONSchemaToMappings,
+    MappingsConverter,
     SchemaParsingException,
+    _ConversionContext,
     jsonschematomappings,
     main,
     process_arguments,
@@ -25,6 +34,33 @@ def test_process_arguments_valid():
     ]
     args = process_arguments()
     assert args.json_schema == ["foo.json"]
+    assert args.max_recursion_depth == DEFAULT_MAX_RECURSION_DEPTH
+    assert args.recursion_fallback == RECURSION_DISABLED
+
+
+def test_process_arguments_recursion():
+    sys.argv = [
+        "jsonschematomappings.py",
+        "foo.json",
+        "--max-recursion-depth",
+        "1",
+        "--recursion-fallback",
+        "flattened",
+    ]
+    args = process_arguments()
+    assert args.max_recursion_depth == 1
+    assert args.recursion_fallback == RECURSION_FLATTENED
+
+
+def test_process_arguments_invalid_recursion_fallback():
+    sys.argv = [
+        "jsonschematomappings.py",
+        "foo.json",
+        "--recursion-fallback",
+        "foo",
+    ]
+    with pytest.raises(SystemExit):
+        process_arguments()
 
 
 def test_process_arguments_missing_required():
@@ -47,7 +83,14 @@ def test_process_arguments_multiple():
 
 @patch(
     "jsonschematomappings.process_arguments",
-    return_value=ObjectView({"json_schema": ["foo.json"], "template": None}),
+    return_value=ObjectView(
+        {
+            "json_schema": ["foo.json"],
+            "template": None,
+            "max_recursion_depth": 1,
+            "recursion_fallback": "flattened",
+        }
+    ),
 )
 @patch(
     "jsonschematomappings.jsonschematomappings",
@@ -57,7 +100,7 @@ def test_main(mock_jsonschematomappings, mock_process_arguments, capsys):
     main()
 
     mock_process_arguments.assert_called_once()
-    mock_jsonschematomappings.assert_called_once_with("foo.json", None)
+    mock_jsonschematomappings.assert_called_once_with("foo.json", None, 1, "flattened")
 
     captured = capsys.readouterr()
     assert captured.out == '{\n  "foo": "bar"\n}\n'
@@ -67,7 +110,9 @@ def test_main(mock_jsonschematomappings, mock_process_arguments, capsys):
 @patch.object(JSONSchemaToMappings, "to_mappings", return_value={"foo": "bar"})
 def test_jsonschematomappings(mock_to_mappings, mock_init):
     assert jsonschematomappings("foo.json") == {"foo": "bar"}
-    mock_init.assert_called_once_with("foo.json", None)
+    mock_init.assert_called_once_with(
+        "foo.json", None, DEFAULT_MAX_RECURSION_DEPTH, RECURSION_DISABLED
+    )
     mock_to_mappings.assert_called_once()
 
 
@@ -350,3 +395,600 @@ def test__convert_property_array_items_invalid_type():
             {"name": {"type": "array", "items": {"type": "array"}}}
         )
     assert "Unable to parse type 'array' within array" in str(e)
+
+
+def test__convert_property_does_not_modify_schema():
+    schema = {
+        "properties": {
+            "name": {"$ref": "#/$defs/foo"},
+            "names": {"type": "array", "items": {"$ref": "#/$defs/foo"}},
+        },
+        "$defs": {"foo": {"type": "integer"}},
+    }
+    original = copy.deepcopy(schema)
+    JSONSchemaToMappings(schema).to_mappings()
+    assert schema == original
+
+
+def test_mappings_converter_regression():
+    converter = MappingsConverter()
+    with open(os.path.join(RESOURCES_DIR, "test_json_schema_mappings.json"), "rt") as f:
+        expected = json.load(f)
+
+    # second call is served from the converter's caches
+    for _ in range(2):
+        mappings = converter.to_mappings(
+            os.path.join(RESOURCES_DIR, "test_json_schema.json")
+        )
+        assert DeepDiff(mappings, expected) == {}
+
+
+def test_mappings_converter_template():
+    template = {"mappings": {"foo": "bar"}, "settings": {"some": "setting"}}
+    converter = MappingsConverter(template=template)
+    expected = {
+        "mappings": {"foo": "bar", "properties": {"name": {"type": "keyword"}}},
+        "settings": {"some": "setting"},
+    }
+
+    assert (
+        converter.to_mappings({"properties": {"name": {"type": "string"}}}) == expected
+    )
+    # template is copied, not merged into
+    assert template == {"mappings": {"foo": "bar"}, "settings": {"some": "setting"}}
+    assert converter.template == template
+
+
+def test_mappings_converter_type_map():
+    converter = MappingsConverter(type_map={"string": "text"})
+    assert converter.to_mappings(
+        {"properties": {"name": {"type": "string"}, "age": {"type": "integer"}}}
+    ) == {
+        "mappings": {"properties": {"name": {"type": "text"}, "age": {"type": "long"}}}
+    }
+    with pytest.raises(TypeError):
+        converter.type_map["string"] = "keyword"
+
+
+def test_mappings_converter_immutable():
+    converter = MappingsConverter()
+    with pytest.raises(AttributeError):
+        converter.foo = "bar"
+    with pytest.raises(AttributeError):
+        converter._template = {}
+
+
+def test_mappings_converter_cached_results_not_shared():
+    converter = MappingsConverter()
+    schema = {
+        "properties": {"name": {"$ref": "#/$defs/foo"}},
+        "$defs": {"foo": {"type": "integer"}},
+    }
+
+    first = converter.to_mappings(schema)
+    first["mappings"]["properties"]["name"]["type"] = "keyword"
+
+    assert converter.to_mappings(schema) == {
+        "mappings": {"properties": {"name": {"type": "long"}}}
+    }
+
+
+def test_mappings_converter_invalid_schema():
+    converter = MappingsConverter()
+    with pytest.raises(fastjsonschema.JsonSchemaException):
+        converter.to_mappings(
+            {"properties": {}, "required": "this should be an array not a string"}
+        )
+    with pytest.raises(KeyError):
+        converter.to_mappings({})
+
+
+def test_mappings_converter_clear_cache():
+    converter = MappingsConverter()
+    converter.to_mappings(
+        {
+            "properties": {"name": {"$ref": "#/$defs/foo"}},
+            "$defs": {"foo": {"type": "integer"}},
+        }
+    )
+    assert converter._validators and converter._converted_defs
+
+    converter.clear_cache()
+    assert not converter._validators and not converter._converted_defs
+
+
+def test_mappings_converter_concurrent():
+    converter = MappingsConverter(template={"settings": {"some": "setting"}})
+    with open(os.path.join(RESOURCES_DIR, "test_json_schema.json"), "rt") as f:
+        regression_schema = json.load(f)
+    with open(os.path.join(RESOURCES_DIR, "test_json_schema_mappings.json"), "rt") as f:
+        regression_mappings = json.load(f)
+    regression_mappings["settings"] = {"some": "setting"}
+
+    # a set of distinct schemas sharing definition names, so the caches
+    # must keep each schema's definitions apart
+    cases = [(regression_schema, regression_mappings)]
+    for i, (t, ot) in enumerate((("string", "keyword"), ("integer", "long")) * 4):
+        schema = {
+            "$id": f"schema{i}",
+            "properties": {
+                "name": {"$ref": f"schema{i}#/$defs/foo"},
+                "names": {"type": "array", "items": {"$ref": f"schema{i}#/$defs/foo"}},
+                f"prop{i}": {"type": "boolean"},
+            },
+            "$defs": {"foo": {"type": t}},
+        }
+        mappings = {
+            "mappings": {
+                "properties": {
+                    "name": {"type": ot},
+                    "names": {"type": ot},
+                    f"prop{i}": {"type": "boolean"},
+                }
+            },
+            "settings": {"some": "setting"},
+        }
+        cases.append((schema, mappings))
+
+    originals = copy.deepcopy(cases)
+
+    def convert(n):
+        schema, expected = cases[n % len(cases)]
+        result = converter.to_mappings(schema)
+        # mutate the result to catch any state shared between calls
+        result["settings"]["some"] = n
+        result["settings"]["some"] = "setting"
+        return result == expected
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(convert, range(2000)))
+
+    assert all(results)
+    assert cases == originals
+
+
+def test_mappings_converter_schema_key():
+    schema = {"properties": {"name": {"type": "string"}}}
+    key = MappingsConverter._schema_key(schema)
+
+    assert MappingsConverter._schema_key(copy.deepcopy(schema)) == key
+    # unaffected by other references to the schema's objects
+    properties = list(schema["properties"].values())
+    assert MappingsConverter._schema_key(schema) == key
+    assert properties
+    assert MappingsConverter._schema_key({"properties": {"name": {}}}) != key
+    # dict subclasses are serialized as JSON instead
+    assert MappingsConverter._schema_key(OrderedDict(schema))
+
+
+def test_mappings_converter_ref_cache_key():
+    converter = MappingsConverter()
+    schema = {
+        "$id": "foo",
+        "properties": {
+            "a": {"$ref": "foo#/$defs/bar", "description": "one"},
+            "b": {"$ref": "#/$defs/bar", "description": "two"},
+        },
+        "$defs": {"bar": {"type": "integer"}},
+    }
+
+    assert converter.to_mappings(schema) == {
+        "mappings": {"properties": {"a": {"type": "long"}, "b": {"type": "long"}}}
+    }
+    # both references share one cached conversion of the definition
+    assert len(converter._converted_defs) == 1
+
+
+def test_mappings_converter_cache_size():
+    converter = MappingsConverter(cache_size=2)
+    schemas = [{"properties": {f"prop{i}": {"type": "string"}}} for i in range(3)]
+    for schema in schemas:
+        converter.to_mappings(schema)
+    assert len(converter._validators) == 2
+
+    # a hit makes the first schema most recently used, so the next is evicted
+    converter.to_mappings(schemas[1])
+    converter.to_mappings(schemas[0])
+    assert list(converter._validators) == [
+        MappingsConverter._schema_key(schemas[1]),
+        MappingsConverter._schema_key(schemas[0]),
+    ]
+
+
+def test_mappings_converter_cache_size_zero():
+    converter = MappingsConverter(cache_size=0)
+    schema = {
+        "properties": {"name": {"$ref": "#/$defs/foo"}},
+        "$defs": {"foo": {"type": "integer"}},
+    }
+    assert converter.to_mappings(schema) == {
+        "mappings": {"properties": {"name": {"type": "long"}}}
+    }
+    assert not converter._validators and not converter._converted_defs
+
+
+def test_mappings_converter_deep_ref_chain():
+    # each level of a chain of references nests the recursion of conversion
+    depth = 250
+    defs = {
+        f"d{i}": {
+            "type": "object",
+            "properties": {"next": {"$ref": f"#/$defs/d{i + 1}"}},
+        }
+        for i in range(depth)
+    }
+    defs[f"d{depth}"] = {"type": "string"}
+    schema = {"properties": {"root": {"$ref": "#/$defs/d0"}}, "$defs": defs}
+
+    expected = {"type": "keyword"}
+    for _ in range(depth):
+        expected = {"properties": {"next": expected}}
+    converter = MappingsConverter()
+    assert converter.to_mappings(schema) == {
+        "mappings": {"properties": {"root": expected}}
+    }
+    assert JSONSchemaToMappings(schema).to_mappings() == {
+        "mappings": {"properties": {"root": expected}}
+    }
+
+
+RECURSIVE_SCHEMA = {
+    "properties": {"root": {"$ref": "#/$defs/Category"}},
+    "$defs": {
+        "Category": {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "children": {"type": "array", "items": {"$ref": "#/$defs/Category"}},
+            },
+        }
+    },
+}
+
+
+def test_jsonschematomappings_recursive(caplog):
+    assert JSONSchemaToMappings(
+        RECURSIVE_SCHEMA, max_recursion_depth=2
+    ).to_mappings() == {
+        "mappings": {
+            "properties": {
+                "root": {
+                    "properties": {
+                        "name": {"type": "keyword"},
+                        "children": {
+                            "type": "nested",
+                            "properties": {
+                                "name": {"type": "keyword"},
+                                "children": {"type": "object", "enabled": False},
+                            },
+                        },
+                    }
+                }
+            }
+        }
+    }
+    assert "Recursive definitions Category (cycle Category -> Category)" in caplog.text
+
+
+def test_mappings_converter_independent_recursion():
+    # Tag is recursive in its own right, so its expansions are counted
+    # separately from the Category chain it is reached from
+    schema = {
+        "properties": {"cat": {"$ref": "#/$defs/Category"}},
+        "$defs": {
+            "Category": {
+                "type": "object",
+                "properties": {
+                    "children": {
+                        "type": "array",
+                        "items": {"$ref": "#/$defs/Category"},
+                    },
+                    "tag": {"$ref": "#/$defs/Tag"},
+                },
+            },
+            "Tag": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "parent": {"$ref": "#/$defs/Tag"},
+                },
+            },
+        },
+    }
+    converter = MappingsConverter(max_recursion_depth=1)
+    expected = {
+        "mappings": {
+            "properties": {
+                "cat": {
+                    "properties": {
+                        "children": {"type": "object", "enabled": False},
+                        "tag": {
+                            "properties": {
+                                "name": {"type": "keyword"},
+                                "parent": {"type": "object", "enabled": False},
+                            }
+                        },
+                    }
+                }
+            }
+        }
+    }
+
+    assert converter.to_mappings(schema) == expected
+    assert converter.find_cycles(schema) == [
+        ["Category", "Category"],
+        ["Tag", "Tag"],
+    ]
+    # served from the caches, which are keyed by each group's expansions
+    assert converter.to_mappings(schema) == expected
+
+
+def test_jsonschematomappings_invalid_recursion_options():
+    # options are validated before the schema is loaded
+    with pytest.raises(ValueError):
+        JSONSchemaToMappings("missing.json", max_recursion_depth=-1)
+    with pytest.raises(ValueError):
+        jsonschematomappings("missing.json", recursion_fallback="foo")
+
+
+def test_jsonschematomappings_recursive_options():
+    assert jsonschematomappings(
+        RECURSIVE_SCHEMA, max_recursion_depth=0, recursion_fallback="flattened"
+    ) == {"mappings": {"properties": {"root": {"type": "flattened"}}}}
+
+
+def test_mappings_converter_recursive_flattened():
+    converter = MappingsConverter(
+        max_recursion_depth=1, recursion_fallback=RECURSION_FLATTENED
+    )
+    assert converter.to_mappings(RECURSIVE_SCHEMA) == {
+        "mappings": {
+            "properties": {
+                "root": {
+                    "properties": {
+                        "name": {"type": "keyword"},
+                        "children": {"type": "flattened"},
+                    }
+                }
+            }
+        }
+    }
+
+
+def test_mappings_converter_recursive_depth_zero():
+    converter = MappingsConverter(max_recursion_depth=0)
+    assert converter.to_mappings(RECURSIVE_SCHEMA) == {
+        "mappings": {"properties": {"root": {"type": "object", "enabled": False}}}
+    }
+
+
+@pytest.mark.parametrize(
+    ("kwargs", "message"),
+    (
+        ({"max_recursion_depth": -1}, "max_recursion_depth must be 0 or more"),
+        ({"recursion_fallback": "foo"}, "Unknown recursion_fallback 'foo'"),
+        ({"cache_size": -1}, "cache_size must be 0 or more"),
+    ),
+)
+def test_mappings_converter_invalid_config(kwargs, message):
+    with pytest.raises(ValueError) as e:
+        MappingsConverter(**kwargs)
+    assert message in str(e)
+
+
+@pytest.mark.parametrize(
+    ("defs", "cycles"),
+    (
+        ({"a": {"type": "string"}}, []),
+        (
+            {
+                "a": {"type": "object", "properties": {"b": {"$ref": "#/$defs/b"}}},
+                "b": {"type": "string"},
+            },
+            [],
+        ),
+        (
+            {"a": {"type": "array", "items": {"$ref": "#/$defs/a"}}},
+            [["a", "a"]],
+        ),
+        (
+            {
+                "a": {"type": "object", "properties": {"b": {"$ref": "#/$defs/b"}}},
+                "b": {"type": "object", "properties": {"c": {"$ref": "#/$defs/c"}}},
+                "c": {"type": "object", "properties": {"a": {"$ref": "#/$defs/a"}}},
+            },
+            [["a", "b", "c", "a"]],
+        ),
+        (
+            {
+                "a": {
+                    "type": "object",
+                    "properties": {
+                        "a": {"$ref": "#/$defs/a"},
+                        "b": {"$ref": "#/$defs/b"},
+                    },
+                },
+                "b": {"type": "object", "properties": {"a": {"$ref": "#/$defs/a"}}},
+            },
+            [["a", "a"]],
+        ),
+        (
+            {
+                "a": {
+                    "type": "object",
+                    "properties": {
+                        "b": {"$ref": "#/$defs/b"},
+                        "c": {"$ref": "#/$defs/c"},
+                    },
+                },
+                "b": {"type": "object", "properties": {"c": {"$ref": "#/$defs/c"}}},
+                "c": {"type": "object", "properties": {"a": {"$ref": "#/$defs/a"}}},
+            },
+            [["a", "c", "a"]],
+        ),
+        (
+            {
+                "a": {
+                    "type": "object",
+                    "properties": {
+                        "b": {"$ref": "#/$defs/b"},
+                        "d": {"$ref": "#/$defs/d"},
+                    },
+                },
+                "b": {"type": "object", "properties": {"c": {"$ref": "#/$defs/c"}}},
+                "c": {"type": "object", "properties": {"a": {"$ref": "#/$defs/a"}}},
+                "d": {"type": "object", "properties": {"b": {"$ref": "#/$defs/b"}}},
+            },
+            [["a", "b", "c", "a"]],
+        ),
+    ),
+)
+def test_mappings_converter_find_cycles(defs, cycles):
+    schema = {"properties": {}, "$defs": defs}
+    assert MappingsConverter().find_cycles(schema) == cycles
+
+
+def test_mappings_converter_mutually_recursive():
+    # each definition references every other, so expanding every reference
+    # path would visit 20^depth definitions
+    n = 20
+    defs = {
+        f"d{i}": {
+            "type": "object",
+            "properties": {f"p{j}": {"$ref": f"#/$defs/d{j}"} for j in range(n)},
+        }
+        for i in range(n)
+    }
+    schema = {"properties": {"root": {"$ref": "#/$defs/d0"}}, "$defs": defs}
+    converter = MappingsConverter(max_recursion_depth=2)
+
+    mappings = converter.to_mappings(schema)
+
+    root = mappings["mappings"]["properties"]["root"]
+    assert root["properties"]["p1"]["properties"]["p2"] == {
+        "type": "object",
+        "enabled": False,
+    }
+    # at most one conversion cached per definition per expansion count
+    assert len(converter._converted_defs) <= n * 2
+    assert converter.find_cycles(schema) == [["d0", "d0"]]
+
+
+@pytest.mark.parametrize(
+    ("refs", "groups"),
+    (
+        (
+            {"a": ["b", "c"], "b": ["c"], "c": ["a"]},
+            ((("a", "b", "c"), ("a", "c", "a")),),
+        ),
+        (
+            {"a": ["b", "d"], "b": ["c"], "c": ["a"], "d": ["b"]},
+            ((("a", "b", "c", "d"), ("a", "b", "c", "a")),),
+        ),
+        (
+            {"a": ["b"], "b": ["a", "c"], "c": ["c"], "d": []},
+            ((("a", "b"), ("a", "b", "a")), (("c",), ("c", "c"))),
+        ),
+    ),
+)
+def test_mappings_converter_recursive_groups(refs, groups, caplog):
+    defs = {
+        k: {
+            "type": "object",
+            "properties": {r: {"$ref": f"#/$defs/{r}"} for r in v},
+        }
+        for k, v in refs.items()
+    }
+    schema = {"properties": {}, "$defs": defs}
+    context = MappingsConverter()._schema_context(
+        schema, MappingsConverter._schema_key(schema)
+    )
+
+    assert context.recursion.groups == groups
+    assert set(context.recursion.group_of) == {k for group, _ in groups for k in group}
+    for group, cycle in groups:
+        assert (
+            f"Recursive definitions {', '.join(group)} (cycle {' -> '.join(cycle)})"
+            in caplog.text
+        )
+
+
+def test_conversion_context_def_refs():
+    context = _ConversionContext({}, "#/$defs/", "")
+    # only properties and items are followed, as in conversion
+    assert context._def_refs(
+        {
+            "$ref": "#/$defs/a",
+            "type": "object",
+            "properties": {
+                "b": {"$ref": "#/$defs/b"},
+                "c": {"type": "array", "items": {"$ref": "#/$defs/c"}},
+                "d": {"enum": [{"$ref": "#/$defs/x"}]},
+                "additionalProperties": True,
+            },
+            "const": {"$ref": "#/$defs/x"},
+            "default": {"$ref": "#/$defs/x"},
+            "examples": [{"$ref": "#/$defs/x"}],
+            "anyOf": [{"$ref": "#/$defs/x"}],
+            "not": {"$ref": "#/$defs/x"},
+        }
+    ) == ["a", "b", "c"]
+
+
+def test_conversion_context_reachable_groups():
+    defs = {
+        k: {
+            "type": "object",
+            "properties": {r: {"$ref": f"#/$defs/{r}"} for r in v},
+        }
+        for k, v in {"a": ["b"], "b": ["a", "c"], "c": ["c"], "d": ["a"]}.items()
+    }
+    recursion = _ConversionContext(defs, "#/$defs/", "").find_recursion()
+
+    assert recursion.group_of == {"a": "a", "b": "a", "c": "c"}
+    assert recursion.reachable == {
+        "a": {"a", "c"},
+        "b": {"a", "c"},
+        "c": {"c"},
+        "d": {"a", "c"},
+    }
+
+
+def test_mappings_converter_recursive_cache_size_zero():
+    converter = MappingsConverter(cache_size=0, max_recursion_depth=1)
+    assert converter.to_mappings(RECURSIVE_SCHEMA) == {
+        "mappings": {
+            "properties": {
+                "root": {
+                    "properties": {
+                        "name": {"type": "keyword"},
+                        "children": {"type": "object", "enabled": False},
+                    }
+                }
+            }
+        }
+    }
+    assert not converter._validators and not converter._converted_defs
+
+
+def test_mappings_converter_concurrent_cycles_logged_once(caplog):
+    converter = MappingsConverter()
+    threads = 8
+    barrier = threading.Barrier(threads)
+    find_recursion = _ConversionContext.find_recursion
+
+    def wait_then_find(context):
+        # every thread misses the cache before any stores its result
+        barrier.wait(timeout=10)
+        return find_recursion(context)
+
+    with patch.object(_ConversionContext, "find_recursion", wait_then_find):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(
+                executor.map(
+                    lambda _: converter.to_mappings(RECURSIVE_SCHEMA), range(threads)
+                )
+            )
+
+    assert all(r == results[0] for r in results)
+    assert caplog.text.count("Recursive definitions Category") == 1